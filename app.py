@@ -1,11 +1,11 @@
 import gradio as gr
 import numpy as np
 import os
-import cv2
+import asyncio
 import uuid
 from pathlib import Path
 
-from cheque_processing_langgraph.__main__ import build_graph
+from cheque_processing_langgraph.__main__ import build_graph, warm_up_llm
 
 # --- Startup: Define root, load assets, build graph ---
 try:
@@ -18,83 +18,138 @@ print("Building the LangGraph application for the Gradio UI...")
 app, text_llm = build_graph()
 print("LangGraph application built successfully.")
 
+# Upper bound on cheques Gradio processes concurrently; their Gemini round-trips overlap.
+MAX_CONCURRENT_CHEQUES = 8
+
+# --- Report table templates (styles are inlined once, not per row) ---
+_TABLE_STYLE = "width: 100%; border-collapse: collapse; text-align: left;"
+_TH_STYLE = "border: 1px solid #ddd; padding: 8px; background-color: #f2f2f2;"
+_TD_STYLE = "border: 1px solid #ddd; padding: 8px;"
+_FIELD_COL_STYLE = "min-width: 170px; font-weight: bold;"
+TABLE_HEAD = (
+    f"<table style='{_TABLE_STYLE}'><thead><tr><th style='{_TH_STYLE}{_FIELD_COL_STYLE}'>Field</th>"
+    f"<th style='{_TH_STYLE}'>Extracted Value</th></tr></thead><tbody>"
+)
+ROW = f"<tr><td style='{_TD_STYLE}{_FIELD_COL_STYLE}'>{{k}}</td><td style='{_TD_STYLE}'>{{v}}</td></tr>"
+
+# Same characters as html.escape(quote=True), applied in a single C-level pass.
+_HTML_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
+def _e(value) -> str:
+    """HTML-escapes a report value."""
+    return str(value).translate(_HTML_ESCAPE)
+
 
 def get_signature_check_result(final_state: dict) -> str:
     """
-    Parses the audit trail to find the result of the signature verification step.
+    Looks up the result of the signature verification step in the audit trail.
     """
     audit_trail = final_state.get("audit_trail")
-    if not audit_trail or not hasattr(audit_trail, 'logs'):
+    if not audit_trail or not hasattr(audit_trail, 'step_results'):
         return "Not Performed"
-    for log in reversed(audit_trail.logs):
-        if "Signature Verification" in log:
-            if "Success" in log: return f"✅ Match ({log.split('Reason: ')[-1]})"
-    if hasattr(audit_trail, 'anomalies'):
-        for anomaly in reversed(audit_trail.anomalies):
-            if "Signature Verification" in anomaly: return f"❌ Mismatch ({anomaly.split('Reason: ')[-1]})"
+    status, reason = audit_trail.step_results.get("Signature Verification", (None, None))
+    if status == "Success":
+        return f"✅ Match ({reason})"
+    if status == "Anomaly":
+        return f"❌ Mismatch ({reason})"
     return "Not Performed"
 
 
-def process_cheque_with_ui(cheque_image_np: np.ndarray):
-    """ Main interface for the Gradio UI. """
-    if cheque_image_np is None:
-        return None, "<h2>Error</h2><p>Please upload a cheque image first.</p>"
+def describe_progress(state: dict) -> str:
+    """Returns a user-facing note on which stage the graph is running next."""
+    if "audit_trail" not in state:
+        return "Starting…"
+    if "is_readable" not in state:
+        return "Checking image quality and extracting cheque details…"
+    if "fraud_detected" not in state:
+        return "Running fraud checks…"
+    return "Validating account…"
 
-    cheque_image_bgr = cv2.cvtColor(cheque_image_np, cv2.COLOR_RGB2BGR)
-    initial_state = {"image": cheque_image_bgr, "project_root": project_root}
-    print(f"Invoking graph with image data and project root...")
-    final_state = app.invoke(initial_state)
-    
-    # --- Generate the HTML Report ---
-    final_decision = final_state.get('final_decision', 'Error')
+
+def build_report_html(final_state: dict, final_decision: str, tail: str) -> str:
+    """Renders the processing report for the current state, followed by `tail`."""
     feedback = "\n".join(final_state.get('feedback', ['An unknown error occurred.']))
     
-    html_report = f"<h2>Cheque Processing Report</h2>"
-    html_report += f"<p><strong>Final Decision:</strong> <code>{final_decision}</code></p>"
+    parts: list[str] = [
+        "<h2>Cheque Processing Report</h2>",
+        f"<p><strong>Final Decision:</strong> <code>{final_decision}</code></p>",
+    ]
     
     cheque_data = final_state.get("cheque_data", {})
     if cheque_data:
-        html_report += "<h3>Extracted & Validated Details</h3>"
+        parts.append("<h3>Extracted & Validated Details</h3>")
         
         # === FIX: Generate a pure HTML table for the gr.HTML() component ===
-        table_style = "width: 100%; border-collapse: collapse; text-align: left;"
-        th_style = "border: 1px solid #ddd; padding: 8px; background-color: #f2f2f2;"
-        td_style = "border: 1px solid #ddd; padding: 8px;"
-        field_col_style = "min-width: 170px; font-weight: bold;"
-        
-        html_report += f"<table style='{table_style}'><thead><tr><th style='{th_style}{field_col_style}'>Field</th><th style='{th_style}'>Extracted Value</th></tr></thead><tbody>"
-        
-        # Populate table rows
-        html_report += f"<tr><td style='{td_style}{field_col_style}'>Payee</td><td style='{td_style}'>{cheque_data.get('payee', 'N/A')}</td></tr>"
-        html_report += f"<tr><td style='{td_style}{field_col_style}'>Amount (Numeric)</td><td style='{td_style}'>{cheque_data.get('amount', 'N/A')}</td></tr>"
-        html_report += f"<tr><td style='{td_style}{field_col_style}'>Amount (in Words)</td><td style='{td_style}'>{cheque_data.get('amount_in_words', 'N/A')}</td></tr>"
-        html_report += f"<tr><td style='{td_style}{field_col_style}'>Date</td><td style='{td_style}'>{cheque_data.get('formatted_date', 'N/A')}</td></tr>"
-        html_report += f"<tr><td style='{td_style}{field_col_style}'>Payer Account No.</td><td style='{td_style}'>{cheque_data.get('payer_account_number', 'N/A')}</td></tr>"
+        parts.append(TABLE_HEAD)
         
         is_date_valid = cheque_data.get('is_date_valid', False)
         date_reason = cheque_data.get('date_validation_reason', 'Validation failed')
         date_valid_text = "✅ Yes" if is_date_valid else f"❌ No ({date_reason})"
-        html_report += f"<tr><td style='{td_style}{field_col_style}'>Is Date Valid?</td><td style='{td_style}'>{date_valid_text}</td></tr>"
         
         is_consistent = cheque_data.get('is_amount_consistent', False)
         consistency_reason = cheque_data.get('validation_reason', 'Mismatch')
         consistency_text = "✅ Yes" if is_consistent else f"❌ No ({consistency_reason})"
-        html_report += f"<tr><td style='{td_style}{field_col_style}'>Amounts Consistent?</td><td style='{td_style}'>{consistency_text}</td></tr>"
         
         signature_result_text = get_signature_check_result(final_state)
-        html_report += f"<tr><td style='{td_style}{field_col_style}'>Signature Match?</td><td style='{td_style}'>{signature_result_text}</td></tr>"
         
-        html_report += "</tbody></table>"
+        # Populate table rows
+        rows = (
+            ("Payee", cheque_data.get('payee', 'N/A')),
+            ("Amount (Numeric)", cheque_data.get('amount', 'N/A')),
+            ("Amount (in Words)", cheque_data.get('amount_in_words', 'N/A')),
+            ("Date", cheque_data.get('formatted_date', 'N/A')),
+            ("Payer Account No.", cheque_data.get('payer_account_number', 'N/A')),
+            ("Is Date Valid?", date_valid_text),
+            ("Amounts Consistent?", consistency_text),
+            ("Signature Match?", signature_result_text),
+        )
+        for field, value in rows:
+            parts.append(ROW.format_map({"k": field, "v": _e(value)}))
+        
+        parts.append("</tbody></table>")
+
+    parts.append(f"<h3>Processing Feedback:</h3><pre><code>{feedback}</code></pre>")
+    parts.append(tail)
+    return "".join(parts)
 
-    html_report += f"<h3>Processing Feedback:</h3><pre><code>{feedback}</code></pre>"
+
+async def process_cheque_with_ui(cheque_image_np: np.ndarray):
+    """
+    Main interface for the Gradio UI.
+    Yields a partial report after every graph step so the user sees progress immediately.
+    """
+    if cheque_image_np is None:
+        yield None, "<h2>Error</h2><p>Please upload a cheque image first.</p>"
+        return
+
+    initial_state = {"image": cheque_image_np, "project_root": project_root}
+    print(f"Streaming graph with image data and project root...")
+    final_state = initial_state
+    async for final_state in app.astream(initial_state, stream_mode="values"):
+        progress = f"<p><em>{describe_progress(final_state)}</em></p>"
+        yield cheque_image_np, build_report_html(final_state, "PROCESSING", progress)
+
+    # Kick off the audit summary now so its Gemini round-trip overlaps the report rendering below.
+    audit_trail = final_state.get("audit_trail")
+    summary_task = asyncio.create_task(audit_trail.generate_llm_summary_report_async(text_llm)) if audit_trail else None
     
-    if final_state.get("audit_trail"):
-        summary = final_state["audit_trail"].generate_llm_summary_report(text_llm)
-        html_report += f"<h3>AI-Generated Audit Summary</h3><p>{summary.replace('/n', '<br>')}</p>"
-    else:
-        html_report += "<h3>Audit trail could not be generated.</h3>"
+    # --- Generate the HTML Report ---
+    final_decision = final_state.get('final_decision', 'Error')
+    
+    if summary_task is None:
+        yield cheque_image_np, build_report_html(final_state, final_decision, "<h3>Audit trail could not be generated.</h3>")
+        return
 
-    return cheque_image_np, html_report
+    yield cheque_image_np, build_report_html(final_state, final_decision, "<p><em>Generating AI audit summary…</em></p>")
+    summary = await summary_task
+    yield cheque_image_np, build_report_html(
+        final_state, final_decision,
+        f"<h3>AI-Generated Audit Summary</h3><p>{summary.replace('/n', '<br>')}</p>",
+    )
+
+async def warm_up():
+    """Connects the Gemini client on Gradio's event loop (first page load only)."""
+    await warm_up_llm(text_llm)
 
 def clear_outputs():
     """Returns empty values to clear the output components."""
@@ -117,7 +172,8 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
     submit_button.click(
         fn=process_cheque_with_ui,
         inputs=[image_input],
-        outputs=[image_output, report_output]
+        outputs=[image_output, report_output],
+        concurrency_limit=MAX_CONCURRENT_CHEQUES,
     )
     
     image_input.upload(
@@ -131,5 +187,7 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
         inputs=[image_input],
     )
 
+    demo.load(fn=warm_up, inputs=None, outputs=None)
+
 if __name__ == "__main__":
     demo.launch()
\ No newline at end of file
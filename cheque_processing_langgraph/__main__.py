@@ -1,14 +1,18 @@
+import logging
 import os
 import uuid
-import json
-from typing import TypedDict, List, Any
+import asyncio
+import functools
+import operator
+from typing import TypedDict, List, Any, Annotated
 from pathlib import Path
 
 import cv2
 import numpy as np
-import pandas as pd
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, END
+from langgraph.types import Send
+from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 from .image_enhancement.enhancer import llm_check_readability
@@ -18,6 +22,9 @@ from .fraud_detection.tampering_detection import llm_detect_tampering
 from .fraud_detection.behavior_analysis import llm_analyze_historical_behavior
 # === IMPORT THE NEW LLM-BASED SIGNATURE COMPARISON MODULE ===
 from .fraud_detection.signature_comparison import llm_compare_signatures
+from .utils import downscale_for_llm, encode_for_gemini, file_to_data_uri
+
+logger = logging.getLogger(__name__)
 
 # This 'database' maps account numbers to payer info, including the signature file.
 PAYER_DATABASE = {
@@ -35,49 +42,107 @@ PAYER_DATABASE = {
     }
 }
 
+load_dotenv()
+
+@functools.lru_cache(maxsize=1)
+def get_llm() -> ChatGoogleGenerativeAI:
+    """
+    Returns the process-wide Gemini client so its connection pool stays warm.
+    The gRPC transport keeps one long-lived, multiplexed channel (plus a lazily created
+    asyncio channel for `ainvoke`) that every agent shares, instead of re-handshaking TLS.
+    """
+    return ChatGoogleGenerativeAI(model="gemini-1.5-pro-latest", temperature=0, transport="grpc")
+
+_llm_warm_up_started = False
+
+async def warm_up_llm(llm: ChatGoogleGenerativeAI) -> None:
+    """
+    Sends one 1-token `ainvoke` so the asyncio gRPC channel used by the graph is connected
+    before the first real cheque. Must run on the serving event loop; at most once per process.
+    """
+    global _llm_warm_up_started
+    if _llm_warm_up_started:
+        return
+    _llm_warm_up_started = True
+    try:
+        await llm.ainvoke([HumanMessage(content="ping")], generation_config={"max_output_tokens": 1})
+        logger.info("Gemini connection warmed up")
+    except Exception as e:
+        logger.warning("Gemini warm-up request failed (continuing): %s", e)
+
+@functools.lru_cache(maxsize=128)
+def _load_reference_signature_uri(project_root: str, rel_path: str) -> str:
+    """
+    Returns a reference signature as a ready-to-send data URI, built once per file. The stored
+    PNG is passed through untouched, so repeat payers skip decoding, channel swaps and re-encoding.
+    """
+    ref_sig_path = Path(project_root) / rel_path
+    if not ref_sig_path.is_file():
+        raise FileNotFoundError(f"Signature file not found at {ref_sig_path}")
+    return file_to_data_uri(ref_sig_path)
+
 class ChequeState(TypedDict):
+    """
+    State passed between the graph nodes.
+
+    Invariant: state['image'] (and the derived state['signature_image']) is RGB uint8 HxWx3,
+    exactly as delivered by Gradio, so no channel swap is needed before encoding for Gemini.
+    state['cheque_image_uri'] is that picture downscaled and encoded once for every Gemini
+    prompt; state['image'] stays full-resolution for geometric work such as the signature crop.
+
+    Nodes return only the fields they change; list fields use `operator.add` reducers so
+    parallel branches can append without copying the whole state.
+    """
     project_root: str
     image: np.ndarray
+    cheque_image_uri: str
     cheque_data: dict
     signature_image: np.ndarray | None
     amount_in_words: str | None
     audit_trail: Any
     is_readable: bool
+    fraud_flags: Annotated[List[bool], operator.add]  # one entry per fraud-detection branch
     fraud_detected: bool
+    fast_reject_enabled: bool  # skip the Gemini fraud checks once local checks fail (default True)
+    llm_fraud_checks_enabled: bool  # also run the Gemini tampering/behavior agents (default False)
     final_decision: str
-    feedback: List[str]
+    feedback: Annotated[List[str], operator.add]
 
+@functools.lru_cache(maxsize=1)
 def build_graph():
-    """Builds and returns the LangGraph compiled workflow."""
-    load_dotenv()
-    llm = ChatGoogleGenerativeAI(model="gemini-1.5-pro-latest", temperature=0)
-    json_llm = llm.bind(response_mime_type="application/json")
+    """Builds and returns the LangGraph compiled workflow (cached for the process lifetime)."""
+    llm = get_llm()
 
     def start_processing(state: ChequeState) -> ChequeState:
         from .audit.trail import AuditTrail
         cheque_id = f"cheque-{uuid.uuid4().hex[:8]}"
         audit_trail = AuditTrail(cheque_id)
         audit_trail.log_step("Start", "Success", "Image data received.")
-        return {**state, "audit_trail": audit_trail, "feedback": []}
+        # Encode once here; every vision agent reuses the same data URI.
+        cheque_image_uri = encode_for_gemini(downscale_for_llm(state["image"]))
+        return {"audit_trail": audit_trail, "cheque_image_uri": cheque_image_uri}
 
-    def check_image_quality(state: ChequeState) -> ChequeState:
-        is_readable, msg = llm_check_readability(state["image"], json_llm)
+    async def check_and_extract(state: ChequeState) -> ChequeState:
+        # Readability and extraction are independent Gemini calls, so extraction runs
+        # speculatively alongside the quality check and is discarded if the image is unreadable.
+        (is_readable, msg), data = await asyncio.gather(
+            llm_check_readability(state["cheque_image_uri"], llm),
+            llm_extract_and_validate_cheque_data(state["image"], state["cheque_image_uri"], llm),
+        )
         if not is_readable:
             state["audit_trail"].highlight_anomaly("Image Quality", msg)
-            return {**state, "is_readable": False}
+            return {"is_readable": False}
         state["audit_trail"].log_step("Image Quality Check", "Success", "Gemini approved image quality.")
-        return {**state, "is_readable": True}
 
-    def extract_data(state: ChequeState) -> ChequeState:
-        data = llm_extract_and_validate_cheque_data(state["image"], json_llm)
         if "error" in data or not all(k in data for k in ["amount", "payee", "payer_account_number", "is_date_valid"]):
             err_msg = data.get("error", "Gemini Vision failed to extract/validate all key fields.")
             state["audit_trail"].log_step("Extraction & Validation", "Failed", err_msg)
-            return {**state, "final_decision": "MANUAL_REVIEW"}
+            return {"is_readable": True, "final_decision": "MANUAL_REVIEW"}
         state["audit_trail"].log_step("Extraction & Validation", "Success", f"Data extracted and validated.")
-        return {**state, "cheque_data": data, "signature_image": data.get("signature_image"), "amount_in_words": data.get("amount_in_words")}
+        return {"is_readable": True, "cheque_data": data, "signature_image": data.get("signature_image"), "amount_in_words": data.get("amount_in_words")}
 
-    def run_fraud_detection(state: ChequeState) -> ChequeState:
+    def fd_dispatch(state: ChequeState) -> dict:
+        """Runs the cheap local checks; the Gemini checks fan out from here via Send."""
         fraud_found = False
         audit_trail = state["audit_trail"]
         
@@ -91,17 +156,26 @@ def build_graph():
             audit_trail.highlight_anomaly("Amount Verification", reason)
             fraud_found = True
 
-        # is_tampered, msg = llm_detect_tampering(state["image"], json_llm)
-        # if is_tampered:
-            # audit_trail.highlight_anomaly("Tampering Detection", msg)
-            # fraud_found = True
-            
-        # is_anomalous, msg = llm_analyze_historical_behavior(state["cheque_data"], PAYER_DATABASE, json_llm)
-        # if is_anomalous:
-            # audit_trail.highlight_anomaly("Behavior Analysis", msg)
-            # fraud_found = True
+        if fraud_found and state.get("fast_reject_enabled", True):
+            audit_trail.log_step("Fraud Detection", "Short-circuited", "Local checks already require manual review; skipping Gemini checks.")
+
+        return {"fraud_flags": [fraud_found]}
+
+    async def fd_tampering(state: ChequeState) -> dict:
+        is_tampered, msg = await llm_detect_tampering(state["cheque_image_uri"], llm)
+        if is_tampered:
+            state["audit_trail"].highlight_anomaly("Tampering Detection", msg)
+        return {"fraud_flags": [is_tampered]}
 
-        # === UPDATE: The signature comparison logic now calls the Gemini agent ===
+    async def fd_behavior(state: ChequeState) -> dict:
+        is_anomalous, msg = await llm_analyze_historical_behavior(state["cheque_data"], PAYER_DATABASE, llm)
+        if is_anomalous:
+            state["audit_trail"].highlight_anomaly("Behavior Analysis", msg)
+        return {"fraud_flags": [is_anomalous]}
+
+    async def fd_signature(state: ChequeState) -> dict:
+        fraud_found = False
+        audit_trail = state["audit_trail"]
         cheque_signature = state.get("signature_image")
         payer_account_number = state["cheque_data"].get("payer_account_number")
 
@@ -112,14 +186,8 @@ def build_graph():
                 fraud_found = True
             else:
                 try:
-                    ref_sig_path = Path(state["project_root"]) / payer_record["payer_signature_path"]
-                    reference_signature = cv2.imread(str(ref_sig_path))
-                    if reference_signature is None:
-                        raise FileNotFoundError(f"Signature file not found at {ref_sig_path}")
-                    
-                    # Call the new Gemini-based comparison function
-                    match, reason = llm_compare_signatures(cheque_signature, reference_signature, json_llm)
-                    
+                    reference_signature_uri = _load_reference_signature_uri(state["project_root"], payer_record["payer_signature_path"])
+                    match, reason = await llm_compare_signatures(cheque_signature, reference_signature_uri, llm)
                     if not match:
                         audit_trail.highlight_anomaly("Signature Verification", reason)
                         fraud_found = True
@@ -127,29 +195,41 @@ def build_graph():
                         audit_trail.log_step("Signature Verification", "Success", reason)
                 except Exception as e:
                     audit_trail.highlight_anomaly("Signature Verification", f"Error during comparison: {e}")
-        
-        audit_trail.log_step("Fraud Detection", "Completed", f"Fraud found: {fraud_found}")
-        return {**state, "fraud_detected": fraud_found}
+
+        return {"fraud_flags": [fraud_found]}
+
+    def fd_aggregate(state: ChequeState) -> dict:
+        fraud_found = any(state.get("fraud_flags", []))
+        state["audit_trail"].log_step("Fraud Detection", "Completed", f"Fraud found: {fraud_found}")
+        return {"fraud_detected": fraud_found}
 
     def validate_and_process(state: ChequeState) -> ChequeState:
         data = state["cheque_data"]
         is_valid, msg = validate_account_details(data.get("payer_account_number", ""))
         if not is_valid:
             state["audit_trail"].highlight_anomaly("Account Validation", msg)
-            return {**state, "final_decision": "REJECT"}
+            return {"final_decision": "REJECT"}
         state["audit_trail"].log_step("Account Validation", "Success", "Account is valid.")
-        state["feedback"].append("Cheque processed successfully.")
-        return {**state, "final_decision": "APPROVE"}
+        return {"final_decision": "APPROVE", "feedback": ["Cheque processed successfully."]}
         
-    def route_after_start(state: ChequeState): return "check_image_quality"
-    def route_after_quality_check(state: ChequeState): return END if not state.get("is_readable") else "extract_data"
-    def route_after_extraction(state: ChequeState): return END if state.get("final_decision") == "MANUAL_REVIEW" else "run_fraud_detection"
+    def route_after_start(state: ChequeState): return "check_and_extract"
+    def route_after_extraction(state: ChequeState): return END if not state.get("is_readable") or state.get("final_decision") == "MANUAL_REVIEW" else "fd_dispatch"
+    def route_fraud_checks(state: ChequeState):
+        if state.get("fast_reject_enabled", True) and any(state.get("fraud_flags", [])):
+            return "fd_aggregate"
+        checks = [Send("fd_signature", state)]
+        # Tampering and behavior analysis are not yet part of the decision policy; opt in per run.
+        if state.get("llm_fraud_checks_enabled", False):
+            checks += [Send("fd_tampering", state), Send("fd_behavior", state)]
+        return checks
     def route_after_fraud_check(state: ChequeState): return "manual_review" if state.get("fraud_detected") else "validate_and_process"
 
     workflow = StateGraph(ChequeState)
-    workflow.add_node("start", start_processing); workflow.add_node("check_image_quality", check_image_quality); workflow.add_node("extract_data", extract_data); workflow.add_node("run_fraud_detection", run_fraud_detection); workflow.add_node("validate_and_process", validate_and_process); workflow.add_node("manual_review", lambda state: {**state, "final_decision": "MANUAL_REVIEW"})
+    workflow.add_node("start", start_processing); workflow.add_node("check_and_extract", check_and_extract); workflow.add_node("validate_and_process", validate_and_process); workflow.add_node("manual_review", lambda state: {"final_decision": "MANUAL_REVIEW"})
+    workflow.add_node("fd_dispatch", fd_dispatch); workflow.add_node("fd_tampering", fd_tampering); workflow.add_node("fd_behavior", fd_behavior); workflow.add_node("fd_signature", fd_signature); workflow.add_node("fd_aggregate", fd_aggregate)
     workflow.set_entry_point("start")
-    workflow.add_conditional_edges("start", route_after_start); workflow.add_conditional_edges("check_image_quality", route_after_quality_check); workflow.add_conditional_edges("extract_data", route_after_extraction); workflow.add_conditional_edges("run_fraud_detection", route_after_fraud_check)
+    workflow.add_conditional_edges("start", route_after_start); workflow.add_conditional_edges("check_and_extract", route_after_extraction); workflow.add_conditional_edges("fd_dispatch", route_fraud_checks, ["fd_tampering", "fd_behavior", "fd_signature", "fd_aggregate"]); workflow.add_conditional_edges("fd_aggregate", route_after_fraud_check)
+    workflow.add_edge("fd_tampering", "fd_aggregate"); workflow.add_edge("fd_behavior", "fd_aggregate"); workflow.add_edge("fd_signature", "fd_aggregate")
     workflow.add_edge("validate_and_process", END); workflow.add_edge("manual_review", END)
     return workflow.compile(), llm
 
@@ -164,11 +244,11 @@ def main():
     if not dbs_cheque_path.exists():
         print(f"FATAL: Ensure 'dbs_cheque.png' exists in {project_root}")
         return
-    cheque_image_data = cv2.imread(str(dbs_cheque_path))
+    cheque_image_data = np.ascontiguousarray(cv2.imread(str(dbs_cheque_path), cv2.IMREAD_COLOR)[..., ::-1])
     app, text_llm = build_graph()
     initial_state = {"image": cheque_image_data, "project_root": project_root}
     print(f"\nStarting Cheque Processing Workflow...")
-    final_state = app.invoke(initial_state)
+    final_state = asyncio.run(app.ainvoke(initial_state))
     print("\n\n" + "=" * 50)
     print("           FINAL CHEQUE PROCESSING OUTCOME")
     print("=" * 50)
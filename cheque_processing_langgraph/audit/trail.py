@@ -1,57 +1,88 @@
 import logging
+from dataclasses import dataclass
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
 
+from ..utils import llm_runnable
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Parsed once at import instead of on every summary request.
+_AUDIT_PROMPT = ChatPromptTemplate.from_template(
+    """You are an AI audit assistant.
+    The following logs detail the automated processing of a cheque (ID: {cheque_id}).
+    Please generate a concise, human-readable summary report.
+
+    The report should include:
+    1. A brief overview of the final outcome (e.g., processed successfully, sent for manual review).
+    2. A summary of any anomalies detected.
+    3. A conclusion.
+
+    Here are the detailed processing logs:
+    {full_log}
+
+    Here are the specific anomalies flagged:
+    {anomaly_log}
+
+    Generate the summary report now.
+    """
+)
+
+def _audit_chain(llm: ChatGoogleGenerativeAI):
+    return llm_runnable(llm, "audit_summary", lambda llm: _AUDIT_PROMPT | llm)
+
+@dataclass(slots=True)
+class LogEntry:
+    """A single processing step recorded by the audit trail."""
+    step: str
+    status: str
+    summary: str
 
 class AuditTrail:
     def __init__(self, cheque_id: str):
         self.cheque_id = cheque_id
-        self.logs = []
+        self.logs: list[LogEntry] = []
         self.anomalies = []
-        print(f"INFO: Started audit trail for Cheque ID: {self.cheque_id}")
+        # Latest (status, summary) per step name, for O(1) lookups by the UI.
+        self.step_results: dict[str, tuple[str, str]] = {}
+        logger.info("Started audit trail for Cheque ID: %s", self.cheque_id)
 
     def log_step(self, step_name: str, status: str, summary: str):
-        log_entry = f"Step: {step_name}, Status: {status}, Summary: {summary}"
-        self.logs.append(log_entry)
-        logging.info(f"[{self.cheque_id}] {log_entry}")
+        self.logs.append(LogEntry(step_name, status, summary))
+        self.step_results[step_name] = (status, summary)
+        logger.info("[%s] Step: %s, Status: %s, Summary: %s", self.cheque_id, step_name, status, summary)
 
     def highlight_anomaly(self, anomaly_source: str, details: str):
         anomaly_entry = f"Source: {anomaly_source}, Details: {details}"
         self.anomalies.append(anomaly_entry)
-        logging.warning(f"[{self.cheque_id}] ANOMALY DETECTED: {anomaly_entry}")
+        self.step_results[anomaly_source] = ("Anomaly", details)
+        logger.warning("[%s] ANOMALY DETECTED: %s", self.cheque_id, anomaly_entry)
+
+    def _summary_chain_inputs(self, llm: ChatGoogleGenerativeAI):
+        full_log = "\n".join(f"{e.step} | {e.status} | {e.summary}" for e in self.logs)
+        anomaly_log = "\n".join(self.anomalies) if self.anomalies else "None"
+        return _audit_chain(llm), {
+            "cheque_id": self.cheque_id,
+            "full_log": full_log,
+            "anomaly_log": anomaly_log,
+        }
 
     def generate_llm_summary_report(self, llm: ChatGoogleGenerativeAI) -> str:
-        print("INFO: Generating final audit summary with Gemini...")
+        logger.info("[%s] Generating final audit summary with Gemini...", self.cheque_id)
         if not self.logs:
             return "No processing steps were logged."
 
-        full_log = "\n".join(self.logs)
-        anomaly_log = "\n".join(self.anomalies) if self.anomalies else "None"
-
-        prompt_template = ChatPromptTemplate.from_template(
-            """You are an AI audit assistant.
-            The following logs detail the automated processing of a cheque (ID: {cheque_id}).
-            Please generate a concise, human-readable summary report.
-
-            The report should include:
-            1. A brief overview of the final outcome (e.g., processed successfully, sent for manual review).
-            2. A summary of any anomalies detected.
-            3. A conclusion.
-
-            Here are the detailed processing logs:
-            {full_log}
+        chain, inputs = self._summary_chain_inputs(llm)
+        response = chain.invoke(inputs)
+        return response.content
 
-            Here are the specific anomalies flagged:
-            {anomaly_log}
+    async def generate_llm_summary_report_async(self, llm: ChatGoogleGenerativeAI) -> str:
+        """Async variant of generate_llm_summary_report, so callers can overlap the Gemini round-trip."""
+        logger.info("[%s] Generating final audit summary with Gemini...", self.cheque_id)
+        if not self.logs:
+            return "No processing steps were logged."
 
-            Generate the summary report now.
-            """
-        )
-        chain = prompt_template | llm
-        response = chain.invoke({
-            "cheque_id": self.cheque_id,
-            "full_log": full_log,
-            "anomaly_log": anomaly_log,
-        })
-        return response.content
\ No newline at end of file
+        chain, inputs = self._summary_chain_inputs(llm)
+        response = await chain.ainvoke(inputs)
+        return response.content
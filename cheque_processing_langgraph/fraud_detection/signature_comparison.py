@@ -1,42 +1,34 @@
-import cv2
+import logging
 import numpy as np
-import json
-import base64
-import io
-from PIL import Image
 from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
+from pydantic import BaseModel, Field
 
-def convert_to_pil_image(image_array: np.ndarray) -> Image.Image:
-    """Converts a BGR numpy array from OpenCV to an RGB PIL Image."""
-    return Image.fromarray(cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB))
+from ..utils import ainvoke_limited, encode_for_gemini, structured_llm
 
-def encode_pil_to_base64_data_uri(pil_image: Image.Image) -> str:
-    """Encodes a PIL image to a Base64 data URI."""
-    buffered = io.BytesIO()
-    pil_image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{img_str}"
+logger = logging.getLogger(__name__)
 
-def llm_compare_signatures(
+class SignatureMatch(BaseModel):
+    """Structured verdict returned by the signature comparison agent."""
+    signatures_match: bool = Field(description="True if you conclude the signatures match, false otherwise.")
+    reason: str = Field(description="A brief, expert justification based on the features you analyzed.")
+
+async def llm_compare_signatures(
     cheque_signature: np.ndarray,
-    reference_signature: np.ndarray,
+    reference_signature_uri: str,
     llm: ChatGoogleGenerativeAI
 ) -> (bool, str):
     """
     Uses Gemini Vision with a forensic analysis prompt to compare two signature images.
-    This is a much more robust method than SSIM.
+    This is a much more robust method than SSIM. The reference arrives pre-encoded as a data URI.
     """
-    print("INFO: Comparing signatures using Gemini forensic analysis agent...")
+    logger.info("Comparing signatures using Gemini forensic analysis agent")
     
-    if cheque_signature is None or reference_signature is None:
+    if cheque_signature is None or not reference_signature_uri:
         return False, "One of the signature images is missing."
 
-    cheque_sig_pil = convert_to_pil_image(cheque_signature)
-    ref_sig_pil = convert_to_pil_image(reference_signature)
-    
-    cheque_sig_uri = encode_pil_to_base64_data_uri(cheque_sig_pil)
-    ref_sig_uri = encode_pil_to_base64_data_uri(ref_sig_pil)
+    # Signatures stay lossless: JPEG artefacts would blur the stroke detail being compared.
+    cheque_sig_uri = encode_for_gemini(cheque_signature, lossy=False)
     
     prompt = HumanMessage(
         content=[
@@ -63,18 +55,16 @@ def llm_compare_signatures(
                 """
             },
             {"type": "image_url", "image_url": cheque_sig_uri},
-            {"type": "image_url", "image_url": ref_sig_uri},
+            {"type": "image_url", "image_url": reference_signature_uri},
         ]
     )
 
     try:
-        response = llm.invoke([prompt])
-        result = json.loads(response.content)
-        match = result.get("signatures_match", False)
-        reason = result.get("reason", "No reason provided.")
-        print(f"INFO: Gemini signature comparison result: Match = {match}, Reason = {reason}")
+        result = await ainvoke_limited(structured_llm(llm, SignatureMatch), [prompt])
+        match, reason = result.signatures_match, result.reason
+        logger.info("Gemini signature comparison result: match=%s, reason=%s", match, reason)
         # Return only the boolean match and the reason
         return match, reason
     except Exception as e:
-        print(f"ERROR: Failed to compare signatures with Gemini: {e}")
+        logger.error("Failed to compare signatures with Gemini: %s", e)
         return False, "Signature comparison analysis failed due to an error."
\ No newline at end of file
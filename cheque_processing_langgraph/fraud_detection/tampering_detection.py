@@ -1,29 +1,22 @@
-import cv2
-import numpy as np
-import json
-import base64
-import io
-from PIL import Image
+import logging
 from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
+from pydantic import BaseModel, Field
 
-# === HELPER FUNCTIONS ADDED HERE ===
-def convert_to_pil_image(image_array: np.ndarray) -> Image.Image:
-    """Converts a BGR numpy array from OpenCV to an RGB PIL Image."""
-    return Image.fromarray(cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB))
+from ..utils import ainvoke_limited, cache_llm_verdict, structured_llm
 
-def encode_pil_to_base64_data_uri(pil_image: Image.Image) -> str:
-    """Encodes a PIL image to a Base64 data URI."""
-    buffered = io.BytesIO()
-    pil_image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{img_str}"
-# ==================================
+logger = logging.getLogger(__name__)
 
-def llm_detect_tampering(image: np.ndarray, llm: ChatGoogleGenerativeAI) -> (bool, str):
-    print("INFO: Analyzing for tampering using Gemini...")
-    pil_image = convert_to_pil_image(image)
-    data_uri = encode_pil_to_base64_data_uri(pil_image)
+class TamperingResult(BaseModel):
+    """Structured verdict returned by the tampering detection agent."""
+    is_tampered: bool = Field(description="True if you suspect tampering, false otherwise.")
+    reason: str = Field(description="A brief explanation of your findings.")
+
+_TAMPERING_FAILED = (True, "Analysis failed, flagging for review.")
+
+@cache_llm_verdict("tampering:v1", cacheable=lambda result: result != _TAMPERING_FAILED)
+async def llm_detect_tampering(data_uri: str, llm: ChatGoogleGenerativeAI) -> (bool, str):
+    logger.info("Analyzing for tampering using Gemini")
 
     prompt = HumanMessage(
         content=[
@@ -50,9 +43,8 @@ def llm_detect_tampering(image: np.ndarray, llm: ChatGoogleGenerativeAI) -> (boo
     )
     
     try:
-        response = llm.invoke([prompt])
-        result = json.loads(response.content)
-        return result.get("is_tampered", False), result.get("reason", "No reason provided.")
+        result = await ainvoke_limited(structured_llm(llm, TamperingResult), [prompt])
+        return result.is_tampered, result.reason
     except Exception as e:
-        print(f"ERROR: Failed to detect tampering with Gemini: {e}")
-        return True, "Analysis failed, flagging for review."
\ No newline at end of file
+        logger.error("Failed to detect tampering with Gemini: %s", e)
+        return _TAMPERING_FAILED
\ No newline at end of file
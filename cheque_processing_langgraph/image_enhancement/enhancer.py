@@ -1,50 +1,67 @@
+import logging
+from functools import lru_cache
+
 import cv2
 import numpy as np
-import json
-import base64
-import io
-from PIL import Image
 from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
+from pydantic import BaseModel, Field
+
+from ..utils import ainvoke_limited, cache_llm_verdict, structured_llm
 
-# === HELPER FUNCTIONS ADDED HERE ===
-def convert_to_pil_image(image_array: np.ndarray) -> Image.Image:
-    """Converts a BGR numpy array from OpenCV to an RGB PIL Image."""
-    return Image.fromarray(cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB))
+logger = logging.getLogger(__name__)
 
-def encode_pil_to_base64_data_uri(pil_image: Image.Image) -> str:
-    """Encodes a PIL image to a Base64 data URI."""
-    buffered = io.BytesIO()
-    pil_image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{img_str}"
-# ==================================
+_READABILITY_FAILED = (False, "Failed to analyze image quality.")
 
 def correct_skew(image: np.ndarray) -> np.ndarray:
-    print("INFO: Correcting image skew...")
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    gray = cv2.bitwise_not(gray)
-    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-    coords = np.column_stack(np.where(thresh > 0))
-    angle = cv2.minAreaRect(coords)[-1]
-    if angle < -45:
-        angle = -(90 + angle)
-    else:
-        angle = -angle
+    """
+    Estimates skew from the long straight edges of the cheque (borders, printed lines)
+    via HoughLinesP, which needs memory proportional to the number of line segments
+    rather than to the number of ink pixels.
+    """
+    logger.debug("Correcting image skew")
     (h, w) = image.shape[:2]
+    # Green alone is an adequate luminance proxy for edge detection and skips the weighted sum.
+    gray = cv2.extractChannel(image, 1) if image.ndim == 3 else image
+    edges = cv2.Canny(gray, 50, 150)
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=200, minLineLength=w // 4, maxLineGap=20)
+    if lines is None:
+        return image
+    # OpenCV 4 returns (N, 1, 4) and OpenCV 5 returns (N, 4); flatten to one layout.
+    lines = lines.reshape(-1, 4)
+    angles = np.degrees(np.arctan2(lines[:, 3] - lines[:, 1], lines[:, 2] - lines[:, 0]))
+    angles = angles[np.abs(angles) < 45]
+    if angles.size == 0:
+        return image
+    angle = float(np.median(angles))
+    # Sub-half-degree skew doesn't affect OCR; skip the full-image resample.
+    if abs(angle) < 0.5:
+        return image
     center = (w // 2, h // 2)
     M = cv2.getRotationMatrix2D(center, angle, 1.0)
-    rotated = cv2.warpAffine(image, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    rotated = cv2.warpAffine(image, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
     return rotated
 
+@lru_cache(maxsize=16)
+def _brightness_contrast_lut(alpha: float, beta: float) -> np.ndarray:
+    """256-entry table built by cv2.convertScaleAbs itself, so it matches its rounding exactly."""
+    lut = cv2.convertScaleAbs(np.arange(256, dtype=np.uint8).reshape(1, 256), alpha=alpha, beta=beta)
+    lut.flags.writeable = False
+    return lut
+
 def enhance_brightness_contrast(image: np.ndarray, alpha=1.5, beta=10) -> np.ndarray:
-    print("INFO: Enhancing brightness and contrast...")
-    return cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
+    logger.debug("Enhancing brightness and contrast")
+    # One table lookup per pixel instead of a multiply-add-abs-saturate.
+    return cv2.LUT(image, _brightness_contrast_lut(alpha, beta))
+
+class ReadabilityResult(BaseModel):
+    """Structured verdict returned by the image quality check."""
+    is_readable: bool = Field(description="True if the image quality is acceptable.")
+    feedback: str = Field(description='A very brief, user-facing comment, e.g. "Image is too dark" or "Quality is good".')
 
-def llm_check_readability(image: np.ndarray, llm: ChatGoogleGenerativeAI) -> (bool, str):
-    print("INFO: Checking image readability using Gemini...")
-    pil_image = convert_to_pil_image(image)
-    data_uri = encode_pil_to_base64_data_uri(pil_image)
+@cache_llm_verdict("readability:v1", cacheable=lambda result: result != _READABILITY_FAILED)
+async def llm_check_readability(data_uri: str, llm: ChatGoogleGenerativeAI) -> (bool, str):
+    logger.info("Checking image readability using Gemini")
     
     prompt = HumanMessage(
         content=[
@@ -70,9 +87,8 @@ def llm_check_readability(image: np.ndarray, llm: ChatGoogleGenerativeAI) -> (bo
     )
     
     try:
-        response = llm.invoke([prompt])
-        result = json.loads(response.content)
-        return result.get("is_readable", False), result.get("feedback", "No feedback provided.")
+        result = await ainvoke_limited(structured_llm(llm, ReadabilityResult), [prompt])
+        return result.is_readable, result.feedback
     except Exception as e:
-        print(f"ERROR: Failed to check readability with Gemini: {e}")
-        return False, "Failed to analyze image quality."
\ No newline at end of file
+        logger.error("Failed to check readability with Gemini: %s", e)
+        return _READABILITY_FAILED
\ No newline at end of file
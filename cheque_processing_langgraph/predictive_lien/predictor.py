@@ -1,13 +1,16 @@
+import logging
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
 
-from ..utils import parse_json_from_response
+from ..utils import ainvoke_limited, parse_json_from_response
 
-def llm_predict_lien_necessity(cheque_data: dict, llm: ChatGoogleGenerativeAI) -> (bool, str):
+logger = logging.getLogger(__name__)
+
+async def llm_predict_lien_necessity(cheque_data: dict, llm: ChatGoogleGenerativeAI) -> (bool, str):
     # ... (prompt setup is the same) ...
     chain = prompt | llm
     try:
-        response = chain.invoke(cheque_data)
+        response = await ainvoke_limited(chain, cheque_data)
         result = parse_json_from_response(response.content)
 
         if result:
@@ -15,9 +18,9 @@ def llm_predict_lien_necessity(cheque_data: dict, llm: ChatGoogleGenerativeAI) -
             if "predict_lien" in standardized_result and "reason" in standardized_result:
                 return standardized_result["predict_lien"], standardized_result["reason"]
 
-        print(f"ERROR: Model returned incomplete/unparseable JSON from lien prediction. Raw: {response.content}")
+        logger.error("Model returned incomplete/unparseable JSON from lien prediction. Raw: %s", response.content)
         return False, "Analysis failed due to model response error."
 
     except Exception as e:
-        print(f"ERROR: API call failed during lien prediction: {e}")
+        logger.error("API call failed during lien prediction: %s", e)
         return False, "Analysis failed due to API error."
\ No newline at end of file
@@ -1,57 +1,100 @@
+import logging
+import asyncio
 import cv2
 import numpy as np
-import json
-import base64
-import io
-from PIL import Image
-from datetime import datetime, timedelta # Import timedelta for stale date checks
+from datetime import date, datetime, timedelta # Import timedelta for stale date checks
+from langchain_core.exceptions import OutputParserException
 from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
+from pydantic import BaseModel, Field, ValidationError
 
-def convert_to_pil_image(image_array: np.ndarray) -> Image.Image:
-    """Converts a BGR numpy array from OpenCV to an RGB PIL Image."""
-    return Image.fromarray(cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB))
+from ..utils import ainvoke_limited, cache_llm_verdict, dumps, structured_llm
 
-def encode_pil_to_base64_data_uri(pil_image: Image.Image) -> str:
-    """Encodes a PIL image to a Base64 data URI."""
-    buffered = io.BytesIO()
-    pil_image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{img_str}"
+logger = logging.getLogger(__name__)
 
-def standardize_keys(data: dict) -> dict:
-    """Converts all keys in a dictionary to lowercase and replaces spaces with underscores."""
-    return {k.lower().replace(' ', '_'): v for k, v in data.items()}
+# Cheques older than this many days are rejected as stale.
+STALE_CHEQUE_DAYS = 180
 
 def parse_bounding_box(bbox_data, image_width, image_height):
-    """Parses bounding box data robustly."""
+    """
+    Converts a relative [x_min, y_min, x_max, y_max] box (the only convention the prompts and
+    schemas ask for) into pixel coordinates. Returns None for anything else: wrong length,
+    values outside [0, 1], or an empty box.
+    """
     try:
-        if isinstance(bbox_data, list) and len(bbox_data) == 4:
-            x_min, y_min, x_max, y_max = bbox_data
-            return int(x_min * image_width), int(y_min * image_height), int(x_max * image_width), int(y_max * image_height)
+        coords = np.asarray(bbox_data, dtype=np.float64)
+        if coords.shape != (4,) or not np.all(np.isfinite(coords)):
+            return None
+        if coords.min() < 0.0 or coords.max() > 1.0:
+            return None
+        x_min, y_min, x_max, y_max = (coords * [image_width, image_height, image_width, image_height]).astype(np.int64).tolist()
+        if x_min >= x_max or y_min >= y_max:
+            return None
+        return x_min, y_min, x_max, y_max
     except Exception as e:
-        print(f"WARNING: Could not parse bounding box data '{bbox_data}'. Error: {e}")
+        logger.warning("Could not parse bounding box data %r: %s", bbox_data, e)
     return None
 
-def validate_cheque_date(date_str: str) -> (bool, str):
+def locate_signature_bbox(image: np.ndarray) -> list[float] | None:
+    """
+    Finds the signature with a cheap OpenCV heuristic instead of a Gemini call.
+    Signatures sit in the lower-right of a cheque, above the MICR band, so the largest
+    wide, non-hairline ink blob there is taken. Returns relative [x_min, y_min, x_max, y_max] or None.
+    """
+    h, w = image.shape[:2]
+    y0, x0 = int(h * 0.55), int(w * 0.5)
+    # The MICR line runs along the bottom ~15% and would otherwise out-score the signature.
+    y1 = int(h * 0.85)
+    roi = image[y0:y1, x0:]
+    roi_h, roi_w = roi.shape[:2]
+    if roi_h == 0 or roi_w == 0:
+        return None
+    gray = cv2.cvtColor(roi, cv2.COLOR_RGB2GRAY)
+    _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    bw = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, np.ones((5, 15), np.uint8))
+    num, _, stats, _ = cv2.connectedComponentsWithStats(bw, connectivity=8)
+    if num <= 1:
+        return None
+
+    # Skip label 0 (background). Keep wide blobs of sensible size that are taller than a
+    # printed rule line and don't run off the bottom of the ROI (MICR ink), then take the largest.
+    stats = stats[1:]
+    tops, heights = stats[:, cv2.CC_STAT_TOP], stats[:, cv2.CC_STAT_HEIGHT]
+    widths, areas = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_AREA]
+    roi_area = roi_h * roi_w
+    candidates = (
+        (widths > 2 * heights)
+        & (tops + heights < roi_h)
+        & (heights > 0.05 * roi_h)
+        & (areas > 0.002 * roi_area)
+        & (areas < 0.5 * roi_area)
+    )
+    if not candidates.any():
+        return None
+    x, y, bw_w, bw_h, _ = stats[candidates][np.argmax(areas[candidates])]
+    return [(x0 + x) / w, (y0 + y) / h, (x0 + x + bw_w) / w, (y0 + y + bw_h) / h]
+
+def validate_cheque_date(date_str: str, *, today: date | None = None, stale_limit: date | None = None) -> (bool, str):
     """
     Validates a date string, expecting a DDMMYYYY format.
+    Batch callers can pass `today` / `stale_limit` once instead of reading the clock per cheque.
     """
     if not isinstance(date_str, str):
         return False, "Date is not a valid string"
 
+    if today is None:
+        today = datetime.now().date()
+    if stale_limit is None:
+        stale_limit = today - timedelta(days=STALE_CHEQUE_DAYS)
+
     if len(date_str) == 6:
         year_suffix = int(date_str[4:])
-        current_year_suffix = int(datetime.now().strftime("%y"))
-        century = "20" if year_suffix <= current_year_suffix else "19"
+        century = "20" if year_suffix <= today.year % 100 else "19"
         date_str = date_str[:4] + century + date_str[4:]
         
     if len(date_str) != 8:
         return False, f"Invalid format (Expected DDMMYYYY, got {date_str})"
 
-    today = datetime.now().date()
-    stale_limit = today - timedelta(days=180)
-
     try:
         cheque_date = datetime.strptime(date_str, "%d%m%Y").date()
     except ValueError:
@@ -61,51 +104,37 @@ def validate_cheque_date(date_str: str) -> (bool, str):
         return False, f"Post-dated cheque (Date: {cheque_date.strftime('%Y-%m-%d')})"
     
     if cheque_date < stale_limit:
-        return False, f"Stale-dated cheque (Date is older than 180 days)"
+        return False, f"Stale-dated cheque (Date is older than {STALE_CHEQUE_DAYS} days)"
 
     return True, "Date is valid"
 
 
-def llm_extract_and_validate_cheque_data(image: np.ndarray, llm: ChatGoogleGenerativeAI) -> dict:
-    """
-    Extracts, validates, and standardizes cheque data using a robust multi-prompt strategy.
-    """
-    print("INFO: Starting multi-step extraction process...")
-    pil_image = convert_to_pil_image(image)
-    data_uri = encode_pil_to_base64_data_uri(pil_image)
+class ChequeTextFields(BaseModel):
+    """Raw text fields read off the cheque."""
+    payee: str = Field(description="The payee name.")
+    date: str = Field(description="The date as a raw string of digits, e.g. DDMMYYYY or DDMMYY.")
+    amount: float = Field(description="The amount in figures.")
+    amount_in_words: str = Field(description="The amount written in words.")
+    micr_line: str = Field(description="The full MICR line.")
 
-    try:
-        # Step 1 & 2: Text and Signature Extraction (Unchanged)
-        print("INFO: Step 1: Extracting text fields...")
-        text_extraction_prompt = HumanMessage(content=[
-            {"type": "text", "text": "You are an OCR AI. Extract the following from the image as a JSON object: Payee, Date (as a raw string of digits), Amount, Amount in Words, and the full MICR Line."},
-            {"type": "image_url", "image_url": data_uri},
-        ])
-        text_response = llm.invoke([text_extraction_prompt])
-        text_data = standardize_keys(json.loads(text_response.content))
-        print(f"INFO: Text data extracted: {text_data}")
-
-        print("INFO: Step 2: Locating signature bounding box...")
-        signature_location_prompt = HumanMessage(content=[
-            {"type": "text", "text": 'You are a visual analysis AI. Identify the signature bounding box. Return ONLY a JSON object with one key, "signature_bbox", containing a list of four relative coordinates: [x_min, y_min, x_max, y_max].'},
-            {"type": "image_url", "image_url": data_uri},
-        ])
-        signature_response = llm.invoke([signature_location_prompt])
-        signature_data = standardize_keys(json.loads(signature_response.content))
-        print(f"INFO: Signature location found: {signature_data}")
-
-        raw_data = {**text_data, **signature_data}
-
-        # Step 3: LLM-based Validation (Amounts and MICR only)
-        print("INFO: Step 3: Validating data with LLM...")
-        
-        # ===== REFINED AND MORE ROBUST VALIDATION PROMPT =====
-        validation_prompt_text = f"""
-        You are a meticulous bank compliance officer AI. Your task is to validate the extracted data from a cheque.
+class SignatureLocation(BaseModel):
+    """Where the signature sits on the cheque."""
+    signature_bbox: list[float] = Field(description="Four relative coordinates between 0 and 1 (fractions of image width/height): [x_min, y_min, x_max, y_max].")
 
-        **Primary Task: Amount Consistency Check**
-        Analyze the `amount` and `amount_in_words` from the JSON data below. You must determine if they are financially equivalent. Pay close attention to variations in how words can represent numbers.
+class ChequeValidation(BaseModel):
+    """LLM-side validation of the extracted fields."""
+    is_amount_consistent: bool = Field(description="True if amount and amount_in_words are financially equivalent.")
+    validation_reason: str = Field(description="Brief explanation of the amount consistency decision.")
+    payer_account_number: str = Field(description="The payer's account number parsed from the MICR line.")
+
+class ChequeExtraction(BaseModel):
+    """Combined result of the fused extraction prompt."""
+    text_fields: ChequeTextFields
+    signature_bbox: list[float] = Field(description="Four relative coordinates between 0 and 1 (fractions of image width/height): [x_min, y_min, x_max, y_max].")
+    validation: ChequeValidation
 
+# Shared by the fused and the multi-step validation prompts.
+_AMOUNT_EQUIVALENCE_EXAMPLES = """
         **Crucial Examples of Equivalence (This is your guide):**
         - `amount: 150.25`, `amount_in_words: "ONE HUNDRED FIFTY & 25/100"` -> `is_amount_consistent: true`
         - `amount: 200.80`, `amount_in_words: "TWO HUNDRED DOLLARS AND EIGHTY CENTS"` -> `is_amount_consistent: true`
@@ -113,7 +142,86 @@ def llm_extract_and_validate_cheque_data(image: np.ndarray, llm: ChatGoogleGener
         - `amount: 100.00`, `amount_in_words: "One Hundred Dollars"` -> `is_amount_consistent: true`
         - `amount: 150.25`, `amount_in_words: "ONE HUNDRED AND TWENTY-FIVE CENTS"` -> `is_amount_consistent: false` (This is 1.25, not 150.25)
         - `amount: 100.00`, `amount_in_words: "Ten Dollars"` -> `is_amount_consistent: false`
+"""
+
+_FUSED_EXTRACTION_PROMPT = f"""
+        You are an OCR AI and a meticulous bank compliance officer. From the attached cheque image, extract and validate the data in one pass.
+
+        **Task 1: Text Extraction** - Payee, Date (as a raw string of digits), Amount, Amount in Words, and the full MICR Line.
+
+        **Task 2: Signature Location** - Identify the signature bounding box as four relative coordinates: [x_min, y_min, x_max, y_max].
+
+        **Task 3: Validation**
+        - Determine if `amount` and `amount_in_words` are financially equivalent. Pay close attention to variations in how words can represent numbers.
+        {_AMOUNT_EQUIVALENCE_EXAMPLES}
+        - From the `micr_line`, extract the Payer's Account Number. It is typically the longest set of digits in the middle.
+
+        **Output requirements:**
+        Return a single JSON object with exactly three top-level keys:
+        1. `text_fields`: object with keys `payee`, `date`, `amount`, `amount_in_words`, `micr_line`.
+        2. `signature_bbox`: list of four relative coordinates [x_min, y_min, x_max, y_max].
+        3. `validation`: object with keys `is_amount_consistent` (boolean), `validation_reason` (string, briefly explain the amount consistency decision), and `payer_account_number` (string).
+        """
+
+async def _extract_fused(data_uri: str, llm: ChatGoogleGenerativeAI) -> (dict, dict):
+    """Extracts text, signature bbox and validation with a single Gemini call."""
+    logger.info("Extracting and validating cheque data with a single fused prompt")
+    prompt = HumanMessage(content=[
+        {"type": "text", "text": _FUSED_EXTRACTION_PROMPT},
+        {"type": "image_url", "image_url": data_uri},
+    ])
+    result = await ainvoke_limited(structured_llm(llm, ChequeExtraction), [prompt])
+    if result is None:
+        raise ValueError("Fused response did not match the ChequeExtraction schema.")
+    raw_data = {**result.text_fields.model_dump(), "signature_bbox": result.signature_bbox}
+    validation_results = result.validation.model_dump()
+    # Field values (payee, account number) are customer data: debug level only.
+    logger.debug("Fused extraction results: %s, %s", raw_data, validation_results)
+    return raw_data, validation_results
+
+async def _extract_multi_step(image: np.ndarray, data_uri: str, llm: ChatGoogleGenerativeAI) -> (dict, dict):
+    """
+    Fallback: separate text, signature and validation prompts.
+    The signature prompt is skipped when the local OpenCV locator finds the signature.
+    """
+    # Step 1 & 2: Text extraction doesn't depend on the signature box, so it is sent first and the
+    # local locator (OpenCV releases the GIL) runs on a worker thread while it is in flight.
+    # The signature prompt is only sent if the locator finds nothing.
+    logger.info("Steps 1 & 2: extracting text fields and locating signature bounding box")
+    text_extraction_prompt = HumanMessage(content=[
+        {"type": "text", "text": "You are an OCR AI. Extract the following from the image as a JSON object: Payee, Date (as a raw string of digits), Amount, Amount in Words, and the full MICR Line."},
+        {"type": "image_url", "image_url": data_uri},
+    ])
+    signature_location_prompt = HumanMessage(content=[
+        {"type": "text", "text": 'You are a visual analysis AI. Identify the signature bounding box. Return ONLY a JSON object with one key, "signature_bbox", containing a list of four relative coordinates between 0 and 1: [x_min, y_min, x_max, y_max].'},
+        {"type": "image_url", "image_url": data_uri},
+    ])
+    text_task = asyncio.create_task(ainvoke_limited(structured_llm(llm, ChequeTextFields), [text_extraction_prompt]))
+    try:
+        signature_bbox = await asyncio.to_thread(locate_signature_bbox, image)
+        logger.debug("Local signature locator result: %s", signature_bbox)
+        if signature_bbox is None:
+            signature_result = await ainvoke_limited(structured_llm(llm, SignatureLocation), [signature_location_prompt])
+            signature_bbox = signature_result.signature_bbox
+        text_result = await text_task
+    finally:
+        text_task.cancel()  # no-op once finished; stops an orphaned call if the signature step failed
+    signature_data = {"signature_bbox": signature_bbox}
+    text_data = text_result.model_dump()
+    logger.debug("Text data extracted: %s; signature location: %s", text_data, signature_data)
+
+    raw_data = {**text_data, **signature_data}
+
+    # Step 3: LLM-based Validation (Amounts and MICR only)
+    logger.info("Step 3: validating data with LLM")
+    
+    # ===== REFINED AND MORE ROBUST VALIDATION PROMPT =====
+    validation_prompt_text = f"""
+        You are a meticulous bank compliance officer AI. Your task is to validate the extracted data from a cheque.
 
+        **Primary Task: Amount Consistency Check**
+        Analyze the `amount` and `amount_in_words` from the JSON data below. You must determine if they are financially equivalent. Pay close attention to variations in how words can represent numbers.
+        {_AMOUNT_EQUIVALENCE_EXAMPLES}
         **Secondary Task: Account Number Parsing**
         - From the `micr_line`, extract the Payer's Account Number. It is typically the longest set of digits in the middle.
 
@@ -125,25 +233,50 @@ def llm_extract_and_validate_cheque_data(image: np.ndarray, llm: ChatGoogleGener
 
         **Data to Validate:**
         ```json
-        {json.dumps(raw_data)}
+        {dumps(raw_data)}
         ```
         Produce the validation JSON object now.
         """
-        # ==========================================================
+    # ==========================================================
+
+    validation_result = await ainvoke_limited(structured_llm(llm, ChequeValidation), [HumanMessage(content=validation_prompt_text)])
+    validation_results = validation_result.model_dump()
+    logger.debug("Validation results from LLM: %s", validation_results)
+    return raw_data, validation_results
 
-        validation_response = llm.invoke([HumanMessage(content=validation_prompt_text)])
-        validation_results = standardize_keys(json.loads(validation_response.content))
-        print(f"INFO: Validation results from LLM: {validation_results}")
+@cache_llm_verdict("extraction:v1")
+async def _extract_llm_fields(data_uri: str, image: np.ndarray, llm: ChatGoogleGenerativeAI) -> (dict, dict):
+    """
+    Gemini-side extraction: fused prompt first, multi-step fallback if it can't be parsed.
+    Transport errors (quota, timeouts, gRPC) propagate: retrying with more calls would only
+    add load to a rate-limited API. Cached per image; callers must not mutate the returned dicts.
+    """
+    try:
+        return await _extract_fused(data_uri, llm)
+    except (OutputParserException, ValidationError, ValueError) as e:
+        logger.warning("Fused extraction failed (%s); falling back to multi-step extraction", e)
+        return await _extract_multi_step(image, data_uri, llm)
+
+async def llm_extract_and_validate_cheque_data(image: np.ndarray, data_uri: str, llm: ChatGoogleGenerativeAI) -> dict:
+    """
+    Extracts, validates, and standardizes cheque data. A single fused prompt is tried first;
+    the multi-prompt strategy is only used if its response can't be parsed.
+    `data_uri` is the pre-encoded image sent to Gemini; `image` is the full-resolution
+    array, used to crop the signature (and to locate it on the multi-step path).
+    """
+    logger.info("Starting extraction process")
+
+    try:
+        raw_data, validation_results = await _extract_llm_fields(data_uri, image, llm)
 
-        # STEP 4: RIGOROUS PROGRAMMATIC DATE VALIDATION (Unchanged)
+        # STEP 4: RIGOROUS PROGRAMMATIC DATE VALIDATION
+        # Recomputed on every call (never cached): the verdict depends on today's date.
         raw_date_str = raw_data.get("date")
         is_valid, reason = validate_cheque_date(raw_date_str)
-        validation_results['is_date_valid'] = is_valid
-        validation_results['date_validation_reason'] = reason
-        print(f"INFO: Programmatic date validation result: {is_valid}, Reason: {reason}")
+        logger.info("Programmatic date validation result: %s, reason: %s", is_valid, reason)
         
-        # Step 5: Final Merge and Processing (Unchanged)
-        final_data = {**raw_data, **validation_results}
+        # Step 5: Final Merge and Processing. Builds a fresh dict so the cached LLM outputs stay untouched.
+        final_data = {**raw_data, **validation_results, "is_date_valid": is_valid, "date_validation_reason": reason}
         
         if 'date' in final_data:
             final_data['formatted_date'] = final_data.pop('date')
@@ -154,6 +287,8 @@ def llm_extract_and_validate_cheque_data(image: np.ndarray, llm: ChatGoogleGener
         signature_image = None
         bbox_raw = final_data.get("signature_bbox")
         if bbox_raw:
+            # Gemini saw the downscaled copy, but the bbox is relative, so scale it by the
+            # full-resolution size and crop from the original for maximum stroke detail.
             h, w, _ = image.shape
             parsed_coords = parse_bounding_box(bbox_raw, w, h)
             if parsed_coords:
@@ -171,7 +306,5 @@ def llm_extract_and_validate_cheque_data(image: np.ndarray, llm: ChatGoogleGener
         return final_data
         
     except Exception as e:
-        import traceback
-        print(f"ERROR: An exception occurred during the multi-step extraction process: {e}")
-        traceback.print_exc()
+        logger.exception("An exception occurred during the extraction process: %s", e)
         return {"error": str(e)}
\ No newline at end of file
@@ -1,4 +1,3 @@
-import cv2
 import numpy as np
 from PIL import Image
 from langchain_core.messages import HumanMessage, SystemMessage
@@ -7,7 +6,7 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 from ..utils import parse_json_from_response, pil_to_base64_uri
 
 def convert_to_pil_image(image_array: np.ndarray) -> Image.Image:
-    return Image.fromarray(cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB))
+    return Image.fromarray(np.ascontiguousarray(image_array[..., ::-1]))
 
 def llm_extract_cheque_data(image: np.ndarray, llm: ChatGoogleGenerativeAI) -> dict:
     """
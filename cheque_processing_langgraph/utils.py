@@ -1,8 +1,73 @@
+import logging
+import asyncio
+import functools
+import hashlib
 import json
+import mimetypes
+import os
 import re
-import base64
-from PIL import Image
+import time
+import binascii
+import cv2
+import numpy as np
 import io
+from typing import TYPE_CHECKING
+
+logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    # PIL is only needed by the legacy extraction path, which passes images in already built.
+    from PIL import Image
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+# Fast JSON codec for LLM payloads. orjson.JSONDecodeError subclasses json.JSONDecodeError,
+# so callers can keep catching the stdlib exception with either backend.
+if orjson is not None:
+    loads = orjson.loads
+
+    def dumps(obj) -> str:
+        """Serializes `obj` to a compact JSON string (numpy values supported)."""
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+else:
+    loads = json.loads
+
+    def dumps(obj) -> str:
+        """Serializes `obj` to a JSON string."""
+        return json.dumps(obj)
+
+# OpenCV often starts single-threaded in containers; a few threads let resize/warpAffine/
+# morphology split the image without oversubscribing the cores shared with concurrent cheques.
+cv2.setNumThreads(min(4, os.cpu_count() or 1))
+
+# Caps in-flight Gemini requests across all concurrent cheques (QPM-limited API).
+MAX_CONCURRENT_GEMINI_CALLS = 8
+gemini_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GEMINI_CALLS)
+
+# JPEG quality used for lossy Gemini uploads; visually lossless for printed cheque text.
+GEMINI_JPEG_QUALITY = 85
+
+# Gemini tiles vision inputs down internally, so pixels beyond this long side only cost bandwidth.
+LLM_MAX_SIDE = 1600
+
+# LLM verdicts are memoized on image content so resubmitting the same cheque is free.
+# The TTL keeps results from outliving policy changes by more than a day. Results hold payee
+# and account data, so they stay in process memory unless LLM_CACHE_DIR opts in to an
+# on-disk diskcache store (unencrypted; shared across runs).
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR")
+LLM_CACHE_TTL = 24 * 60 * 60
+LLM_CACHE_MAX_ENTRIES = 512  # in-memory store only; oldest entries are evicted first
+
+# Non-greedy so a reply with several fenced blocks can't trigger pathological backtracking.
+_MD_JSON = re.compile(r"```(?:json\s*)?({.*?})\s*```", re.DOTALL)
 
 def parse_json_from_response(content: str) -> dict | None:
     """
@@ -10,41 +75,174 @@ def parse_json_from_response(content: str) -> dict | None:
     Handles plain JSON and JSON wrapped in markdown backticks.
     """
     if not isinstance(content, str):
-        print(f"ERROR: Expected a string response, but got {type(content)}")
+        logger.error("Expected a string response, but got %s", type(content))
         return None
         
+    # Case 1: The response is already a perfect JSON string.
+    # Only worth attempting when it starts like an object; fenced replies skip straight to Case 2.
+    if content.lstrip()[:1] == "{":
+        try:
+            return loads(content)
+        except json.JSONDecodeError:
+            pass
+
+    # Case 2: The JSON is wrapped in markdown backticks.
+    match = _MD_JSON.search(content)
+    if match:
+        json_str = match.group(1)
+        try:
+            return loads(json_str)
+        except json.JSONDecodeError as e:
+            logger.error("Found JSON in markdown, but failed to parse: %s\nError: %s", json_str, e)
+            return None
+
+    # Case 3: JSON is not wrapped, but might have prefixes/suffixes.
     try:
-        # Case 1: The response is already a perfect JSON string.
-        return json.loads(content)
-    except json.JSONDecodeError:
-        # Case 2: The JSON is wrapped in markdown backticks.
-        match = re.search(r"```(?:json\s*)?({.*})\s*```", content, re.DOTALL)
-        if match:
-            json_str = match.group(1)
-            try:
-                return json.loads(json_str)
-            except json.JSONDecodeError as e:
-                print(f"ERROR: Found JSON in markdown, but failed to parse: {json_str}\nError: {e}")
-                return None
+        start = content.find('{')
+        end = content.rfind('}') + 1
+        if start != -1 and end != 0:
+            potential_json = content[start:end]
+            return loads(potential_json)
         else:
-            # Case 3: JSON is not wrapped, but might have prefixes/suffixes.
-            try:
-                start = content.find('{')
-                end = content.rfind('}') + 1
-                if start != -1 and end != 0:
-                    potential_json = content[start:end]
-                    return json.loads(potential_json)
-                else:
-                    print(f"ERROR: Could not find a JSON object in the response: {content}")
-                    return None
-            except json.JSONDecodeError as e:
-                print(f"ERROR: Failed to parse extracted JSON substring. Error: {e}\nContent: {content}")
-                return None
+            logger.error("Could not find a JSON object in the response: %s", content)
+            return None
+    except json.JSONDecodeError as e:
+        logger.error("Failed to parse extracted JSON substring. Error: %s\nContent: %s", e, content)
+        return None
 
 # --- NEW HELPER FUNCTION ---
-def pil_to_base64_uri(pil_image: Image.Image) -> str:
-    """Converts a PIL Image object to a Base64 encoded Data URI."""
+def pil_to_base64_uri(pil_image: "Image.Image", fmt: str = "JPEG", quality: int = GEMINI_JPEG_QUALITY) -> str:
+    """
+    Converts a PIL Image object to a Base64 encoded Data URI.
+    JPEG by default (small payload, fast encode); fmt="PNG" stays lossless but uses
+    zlib's fastest level (compress_level=1).
+    """
     buffered = io.BytesIO()
-    pil_image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{img_str}"
\ No newline at end of file
+    if fmt == "PNG":
+        pil_image.save(buffered, format="PNG", compress_level=1)
+    else:
+        pil_image.save(buffered, format=fmt, quality=quality)
+    img_str = binascii.b2a_base64(buffered.getbuffer(), newline=False).decode("ascii")
+    return f"data:image/{fmt.lower()};base64,{img_str}"
+
+def llm_scale_factor(height: int, width: int, max_side: int = LLM_MAX_SIDE) -> float:
+    """Factor `downscale_for_llm` applies to an image of this size (1.0 if it is left as is)."""
+    return min(1.0, max_side / max(height, width))
+
+def downscale_for_llm(image: np.ndarray, max_side: int = LLM_MAX_SIDE) -> np.ndarray:
+    """Shrinks an image so its longest side is at most `max_side` pixels (never upscales)."""
+    h, w = image.shape[:2]
+    scale = llm_scale_factor(h, w, max_side)
+    if scale < 1.0:
+        return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image
+
+def encode_for_gemini(image: np.ndarray, lossy: bool = True) -> str:
+    """
+    Encodes an RGB image as a Base64 data URI for Gemini vision prompts.
+    JPEG (Q85) by default; pass lossy=False for PNG where fine detail matters (e.g. signatures).
+    Uses OpenCV's encoder directly on the pixel buffer, skipping the PIL/BytesIO round-trip.
+    """
+    if image.ndim == 3:
+        # Pipeline images are RGB (see ChequeState); OpenCV's encoders expect BGR.
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    if lossy:
+        ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, GEMINI_JPEG_QUALITY])
+        mime_type = "image/jpeg"
+    else:
+        ok, buf = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        mime_type = "image/png"
+    if not ok:
+        raise ValueError("OpenCV failed to encode the image for Gemini.")
+    # b2a_base64 reads the encoded buffer in place; no intermediate bytes copy.
+    return f"data:{mime_type};base64,{binascii.b2a_base64(buf, newline=False).decode('ascii')}"
+
+# Runnables derived from an llm (prompt chains, structured-output wrappers). Pydantic LLM
+# models are unhashable, so entries are keyed by id(); the llm is kept alongside its
+# runnable so the id cannot be recycled while the entry exists.
+_LLM_RUNNABLES = {}
+
+def llm_runnable(llm, key, build):
+    """Returns `build(llm)`, built once per llm and `key`."""
+    cached = _LLM_RUNNABLES.get((id(llm), key))
+    if cached is None or cached[0] is not llm:
+        cached = (llm, build(llm))
+        _LLM_RUNNABLES[(id(llm), key)] = cached
+    return cached[1]
+
+def structured_llm(llm, schema):
+    """Returns `llm.with_structured_output(schema)`, built once per llm and schema."""
+    return llm_runnable(llm, schema, lambda llm: llm.with_structured_output(schema))
+
+def file_to_data_uri(path) -> str:
+    """Wraps an image file's bytes as a data URI as-is; no decode/re-encode round-trip."""
+    mime_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+    with open(path, "rb") as f:
+        return f"data:{mime_type};base64,{binascii.b2a_base64(f.read(), newline=False).decode('ascii')}"
+
+async def ainvoke_limited(runnable, messages):
+    """Invokes a Gemini runnable asynchronously under the shared concurrency cap."""
+    async with gemini_semaphore:
+        return await runnable.ainvoke(messages)
+
+def content_key(data_uri: str) -> str:
+    """Content hash of an encoded (already downscaled) image data URI."""
+    return hashlib.blake2b(data_uri.encode(), digest_size=16).hexdigest()
+
+@functools.lru_cache(maxsize=1)
+def _disk_cache():
+    """The opt-in on-disk store, or None for the default per-process dict."""
+    if LLM_CACHE_DIR and diskcache is not None:
+        return diskcache.Cache(LLM_CACHE_DIR)
+    if LLM_CACHE_DIR:
+        logger.warning("LLM_CACHE_DIR is set but diskcache is not installed; caching in memory only")
+    return None
+
+_memory_cache = {}
+
+def _cache_get(key: str):
+    disk = _disk_cache()
+    if disk is not None:
+        return disk.get(key)
+    entry = _memory_cache.get(key)
+    if entry is None or entry[0] < time.monotonic():
+        _memory_cache.pop(key, None)
+        return None
+    return entry[1]
+
+def _cache_set(key: str, value) -> None:
+    disk = _disk_cache()
+    if disk is not None:
+        disk.set(key, value, expire=LLM_CACHE_TTL)
+        return
+    _memory_cache[key] = (time.monotonic() + LLM_CACHE_TTL, value)
+    while len(_memory_cache) > LLM_CACHE_MAX_ENTRIES:
+        del _memory_cache[next(iter(_memory_cache))]
+
+def cache_llm_verdict(namespace: str, cacheable=lambda result: True):
+    """
+    Memoizes an async function called as `fn(data_uri, ..., llm)`, keyed on the namespace,
+    the llm's model name and the data URI's content hash. `namespace` should carry a version
+    (e.g. "extraction:v1"); bump it whenever the prompt, schema or return shape changes.
+    Only cache pure LLM outputs, never anything that depends on the clock. Results rejected
+    by `cacheable` (e.g. the fallback returned when the Gemini call failed) are not stored,
+    so errors are retried. Disk I/O runs off the event loop.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(data_uri, *args, **kwargs):
+            llm = args[-1]
+            key = f"{namespace}:{getattr(llm, 'model', type(llm).__name__)}:{content_key(data_uri)}"
+            on_disk = _disk_cache() is not None
+            cached = await asyncio.to_thread(_cache_get, key) if on_disk else _cache_get(key)
+            if cached is not None:
+                return cached
+            result = await fn(data_uri, *args, **kwargs)
+            if cacheable(result):
+                if on_disk:
+                    await asyncio.to_thread(_cache_set, key, result)
+                else:
+                    _cache_set(key, result)
+            return result
+        return wrapper
+    return decorator
@@ -7,17 +7,23 @@ setup(
     description="A multi-agent cheque processing system using LangGraph and Google Gemini with a Gradio UI.",
     packages=find_packages(),
     install_requires=[
-        "langgraph>=0.0.48",
+        "langgraph>=0.2.0",
         "langchain-google-genai>=1.0.3",
         "pillow>=10.0.0",
         "opencv-python>=4.8.0",
         "scikit-image>=0.21.0",
         "numpy>=1.24.0",
         "pandas>=2.0.0",
+        "pydantic>=2.0",
+        "orjson>=3.9.0",
         "python-dotenv>=1.0.0",
         "gradio>=4.20.0",
         "requests>=2.31.0",
     ],
+    extras_require={
+        # Opt-in on-disk LLM verdict cache (enabled by setting LLM_CACHE_DIR).
+        "disk-cache": ["diskcache>=5.6.0"],
+    },
     entry_points={
         "console_scripts": [
             "cheque-processor-cli=cheque_processing_langgraph.__main__:main",
@@ -28,5 +34,5 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.9',
+    python_requires='>=3.10',
 )
\ No newline at end of file
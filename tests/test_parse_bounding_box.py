@@ -0,0 +1,39 @@
+from cheque_processing_langgraph.processing.ocr_extraction import parse_bounding_box
+
+
+def test_relative_box_is_scaled_to_pixels():
+    assert parse_bounding_box([0.5, 0.6, 0.9, 0.8], 2000, 900) == (1000, 540, 1800, 720)
+
+
+def test_tuple_input_is_accepted():
+    assert parse_bounding_box((0.0, 0.0, 1.0, 1.0), 100, 50) == (0, 0, 100, 50)
+
+
+def test_pixel_box_is_rejected():
+    assert parse_bounding_box([600, 300, 900, 400], 1000, 450) is None
+
+
+def test_mixed_scale_box_is_rejected():
+    assert parse_bounding_box([0.5, 2, 0.9, 3], 1000, 450) is None
+
+
+def test_negative_coordinate_is_rejected():
+    assert parse_bounding_box([-0.1, 0.2, 0.5, 0.6], 1000, 450) is None
+
+
+def test_inverted_box_is_rejected():
+    assert parse_bounding_box([0.9, 0.2, 0.5, 0.6], 1000, 450) is None
+    assert parse_bounding_box([0.5, 0.6, 0.9, 0.2], 1000, 450) is None
+
+
+def test_box_collapsing_to_zero_pixels_is_rejected():
+    assert parse_bounding_box([0.5, 0.5, 0.5001, 0.6], 100, 100) is None
+
+
+def test_wrong_length_is_rejected():
+    assert parse_bounding_box([0.1, 0.2, 0.3], 1000, 450) is None
+    assert parse_bounding_box(None, 1000, 450) is None
+
+
+def test_non_numeric_is_rejected():
+    assert parse_bounding_box(["a", "b", "c", "d"], 1000, 450) is None